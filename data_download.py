@@ -3,18 +3,27 @@ SpiderRock Options Data Download via PyKX
 ==========================================
 
 Connects to SpiderRock's kdb+ database to fetch intraday options trade data.
-Saves to CSV for analysis with the volatility surface tools.
+Saves to CSV (or Parquet) for analysis with the volatility surface tools.
 
 Requirements:
-    pip install pykx pandas
+    pip install pykx pyarrow
 
 License:
     Requires SpiderRock data subscription and kc.lic file in working directory.
 """
 
+import multiprocessing
 import os
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
+from multiprocessing.util import Finalize
+
+# Connection owned by the current download worker process
+_worker_conn = None
 
 
 def connect_spiderrock():
@@ -30,7 +39,7 @@ def connect_spiderrock():
     return kx.SyncQConnection(host=host, port=port)
 
 
-def fetch_opra_trades(conn, date: str, ticker: str = 'SPY') -> pd.DataFrame:
+def fetch_opra_trades(conn, date: str, ticker: str = 'SPY') -> pa.Table:
     """
     Fetch OPRA option trades for a given date and ticker.
     
@@ -40,7 +49,7 @@ def fetch_opra_trades(conn, date: str, ticker: str = 'SPY') -> pd.DataFrame:
         ticker: Underlying symbol (default: SPY)
     
     Returns:
-        DataFrame with columns matching SpiderRock opratrade schema
+        Arrow Table with columns matching SpiderRock opratrade schema
     """
     query = f"""
     select 
@@ -54,46 +63,94 @@ def fetch_opra_trades(conn, date: str, ticker: str = 'SPY') -> pd.DataFrame:
     """
     
     result = conn(query)
-    return result.pd()
+    return result.pa()
+
+
+def write_trades(table: pa.Table, filename: str):
+    """
+    Write a trades table to disk straight from Arrow, without a pandas copy.
+    
+    Args:
+        table: Arrow Table from fetch_opra_trades
+        filename: Output path; '.parquet' writes zstd Parquet, anything else CSV
+    """
+    if filename.endswith('.parquet'):
+        pq.write_table(table, filename, compression='zstd')
+    else:
+        pacsv.write_csv(table, filename, write_options=pacsv.WriteOptions(batch_size=65536))
+
 
+def _init_worker():
+    global _worker_conn
+    _worker_conn = connect_spiderrock()
+    Finalize(None, _worker_conn.close, exitpriority=0)
 
-def download_date_range(start_date: str, end_date: str, ticker: str = 'SPY'):
+
+def _fetch_and_save(date_str: str, filename: str, ticker: str) -> int:
+    table = fetch_opra_trades(_worker_conn, date_str, ticker)
+    if len(table) > 0:
+        write_trades(table, filename)
+    return len(table)
+
+
+def download_date_range(start_date: str, end_date: str, ticker: str = 'SPY', fmt: str = 'csv',
+                        max_workers: int = 8):
     """
     Download options data for a date range.
     
+    Dates are fetched concurrently by a pool of worker processes, each
+    holding its own connection to the kdb+ server. Processes rather than
+    threads are used because licensed-mode PyKX (kc.lic) only allows calls
+    into q from the main thread unless PYKX_THREADING is enabled. Workers
+    are spawned, so scripts calling this must guard their entry point with
+    ``if __name__ == '__main__':``.
+    
     Args:
         start_date: Start date as 'YYYY-MM-DD'
         end_date: End date as 'YYYY-MM-DD'
         ticker: Underlying symbol
+        fmt: Output format, 'csv' or 'parquet'
+        max_workers: Number of worker processes/connections
     """
-    conn = connect_spiderrock()
-    
     start = datetime.strptime(start_date, '%Y-%m-%d')
     end = datetime.strptime(end_date, '%Y-%m-%d')
     
+    pending = []
     current = start
     while current <= end:
         date_str = current.strftime('%Y.%m.%d')
-        filename = f"Opratrade_{date_str}_{ticker}.csv"
+        filename = f"Opratrade_{date_str}_{ticker}.{fmt}"
         
         if os.path.exists(filename):
             print(f"  Skip {filename} (exists)")
-            current += timedelta(days=1)
-            continue
-        
-        try:
-            df = fetch_opra_trades(conn, date_str, ticker)
-            if len(df) > 0:
-                df.to_csv(filename, index=False)
-                print(f"  Saved {filename} ({len(df):,} trades)")
-            else:
-                print(f"  Skip {date_str} (no data)")
-        except Exception as e:
-            print(f"  Error {date_str}: {e}")
+        else:
+            pending.append((date_str, filename))
         
         current += timedelta(days=1)
     
-    conn.close()
+    if not pending:
+        return
+    
+    # Fail fast with the real connection error rather than a broken pool
+    connect_spiderrock().close()
+    
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                             initializer=_init_worker) as pool:
+        futures = {pool.submit(_fetch_and_save, d, f, ticker): (d, f) for d, f in pending}
+        for future in as_completed(futures):
+            date_str, filename = futures[future]
+            try:
+                n = future.result()
+                if n > 0:
+                    print(f"  Saved {filename} ({n:,} trades)")
+                else:
+                    print(f"  Skip {date_str} (no data)")
+            except BrokenProcessPool as e:
+                print(f"  Error: download workers failed, remaining dates skipped ({e})")
+                break
+            except Exception as e:
+                print(f"  Error {date_str}: {e}")
 
 
 def download_sample_day():
@@ -105,14 +162,14 @@ def download_sample_day():
         ticker = 'SPY'
         
         print(f"Downloading {ticker} trades for {date}...")
-        df = fetch_opra_trades(conn, date, ticker)
+        table = fetch_opra_trades(conn, date, ticker)
         
         filename = f"Dec2023_Opratrade_{date}_{ticker}.csv"
-        df.to_csv(filename, index=False)
-        print(f"Saved {filename} ({len(df):,} trades)")
+        write_trades(table, filename)
+        print(f"Saved {filename} ({len(table):,} trades)")
         
         conn.close()
-        return df
+        return table.to_pandas()
         
     except Exception as e:
         print(f"Connection failed: {e}")
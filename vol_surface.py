@@ -5,69 +5,122 @@ Implied Volatility Surface Builder
 import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
-from scipy.interpolate import griddata
 import warnings
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 warnings.filterwarnings('ignore')
 
+TRADE_DTYPES = {
+    'prtPrice': 'float32',
+    'prtSize': 'float32',
+    'prtIv': 'float32',
+    'uBid': 'float32',
+    'uAsk': 'float32',
+    'uPrc': 'float32',
+    'okey_xx': 'float32',
+    'okey_yr': 'int16',
+    'okey_mn': 'int8',
+    'okey_dy': 'int8',
+    'okey_cp': 'category',
+    'ticker_tk': 'category'
+}
+
 
 def load_trades(path: str) -> pd.DataFrame:
-    df = pd.read_csv(path)
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+        df = df.astype({c: t for c, t in TRADE_DTYPES.items() if c in df.columns})
+    else:
+        df = pd.read_csv(path, dtype=TRADE_DTYPES, engine='pyarrow')
     
     ts_col = 'timestamp' if 'timestamp' in df.columns else 'prtTimestamp'
-    df['timestamp'] = pd.to_datetime(df[ts_col].str.replace('D', 'T', regex=False), errors='coerce')
+    ts = df[ts_col]
+    first = ts.dropna().head(1)
+    kdb_style = ts.dtype.kind != 'M' and not first.empty and 'D' in str(first.iloc[0])
+    ts_format = '%Y.%m.%dD%H:%M:%S.%f' if kdb_style else 'ISO8601'
+    df['timestamp'] = pd.to_datetime(ts, format=ts_format, errors='coerce', cache=True)
     df['timestamp'] = df['timestamp'] - pd.Timedelta(hours=5)
     
-    for col in ['prtPrice', 'prtSize', 'uBid', 'uAsk', 'uPrc', 'okey_xx', 'prtIv']:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
     if 'ticker_tk' in df.columns:
         df = df[df['ticker_tk'] == 'SPY'].copy()
     
-    df['expiration'] = pd.to_datetime(
-        df['okey_yr'].astype(str) + '-' +
-        df['okey_mn'].astype(str).str.zfill(2) + '-' +
-        df['okey_dy'].astype(str).str.zfill(2)
-    )
+    df['expiration'] = pd.to_datetime({
+        'year': df['okey_yr'],
+        'month': df['okey_mn'],
+        'day': df['okey_dy']
+    })
     
     return df
 
 
 def filter_trades(df: pd.DataFrame, bucket_freq: str = '5min') -> pd.DataFrame:
-    df = df[
-        (df['prtPrice'] >= 0.05) &
-        (df['prtSize'] > 0) &
-        (df['prtIv'] > 0.02) &
-        (df['prtIv'] < 1.0) &
-        (df['uPrc'] > 0)
-    ].copy()
-    
-    df['moneyness'] = df['okey_xx'] / df['uPrc']
-    df = df[(df['moneyness'] >= 0.80) & (df['moneyness'] <= 1.20)]
-    
-    df['is_otm'] = (
-        ((df['okey_cp'] == 'Put') & (df['okey_xx'] < df['uPrc'])) |
-        ((df['okey_cp'] == 'Call') & (df['okey_xx'] > df['uPrc']))
+    # With no valid timestamps every row is masked out below, so any date works
+    first = df['timestamp'].min()
+    ref_date = first.normalize() if pd.notna(first) else pd.Timestamp(0)
+    
+    ts = df['timestamp'].to_numpy()
+    price = df['prtPrice'].to_numpy()
+    size = df['prtSize'].to_numpy()
+    iv = df['prtIv'].to_numpy()
+    xx = df['okey_xx'].to_numpy()
+    u = df['uPrc'].to_numpy()
+    cp = df['okey_cp'].cat.codes.to_numpy()
+    put_code, call_code = df['okey_cp'].cat.categories.get_indexer(['Put', 'Call'])
+    
+    mny = xx / u
+    dte = (df['expiration'].to_numpy() - ref_date.to_datetime64()) // np.timedelta64(1, 'D')
+    
+    keep = (
+        (price >= 0.05) &
+        (size > 0) &
+        (iv > 0.02) &
+        (iv < 1.0) &
+        (u > 0) &
+        (mny >= 0.80) & (mny <= 1.20) &
+        (dte > 0) &
+        ~np.isnat(ts)
     )
+    df = df.loc[keep].assign(moneyness=mny[keep], days_to_exp=dte[keep])
     
-    df['bucket_time'] = df['timestamp'].dt.floor(bucket_freq)
+    # Missing categories and missing okey_cp values both map to code -1
+    xx, u, cp = xx[keep], u[keep], cp[keep]
+    df['is_otm'] = (
+        (cp >= 0) & (
+            ((cp == put_code) & (xx < u)) |
+            ((cp == call_code) & (xx > u))
+        )
+    ).astype(np.int8)
     
-    ref_date = df['bucket_time'].min().normalize()
-    df['days_to_exp'] = (df['expiration'] - ref_date).dt.days
-    df = df[df['days_to_exp'] > 0]
+    step = pd.tseries.frequencies.to_offset(bucket_freq).nanos
+    ns = ts[keep].astype('datetime64[ns]').view('i8')
+    df['bucket_time'] = (ns // step * step).view('datetime64[ns]')
     
     return df
 
 
 def aggregate_curves(df: pd.DataFrame, min_volume: int = 2) -> pd.DataFrame:
-    agg = df.groupby(['bucket_time', 'expiration', 'okey_xx', 'okey_cp', 'is_otm']).agg({
-        'prtIv': lambda x: np.average(x, weights=df.loc[x.index, 'prtSize']),
+    time_dtypes = df[['bucket_time', 'expiration']].dtypes
+    df = df.assign(
+        _ivw=df['prtIv'] * df['prtSize'],
+        bucket_time=df['bucket_time'].to_numpy().view('i8'),
+        expiration=df['expiration'].to_numpy().view('i8')
+    )
+    g = df.groupby(['bucket_time', 'expiration', 'okey_xx', 'okey_cp', 'is_otm'],
+                   sort=False, observed=True)
+    rest = g.agg({
+        '_ivw': 'sum',
         'prtSize': 'sum',
         'days_to_exp': 'first',
         'uPrc': 'first',
         'moneyness': 'first'
-    }).reset_index()
+    })
+    iv = rest.pop('_ivw') / rest['prtSize']
+    agg = pd.concat([iv.rename('iv'), rest], axis=1).reset_index()
+    agg = agg.astype(time_dtypes.to_dict())
     
     agg.columns = ['bucket_time', 'expiration', 'strike', 'cp', 'is_otm',
                    'iv', 'volume', 'days_to_exp', 'underlying', 'moneyness']
@@ -79,14 +132,106 @@ def aggregate_curves(df: pd.DataFrame, min_volume: int = 2) -> pd.DataFrame:
     return agg
 
 
+def _scatter_bilinear(strikes, dte, iv, k0, dk, nk, t0, dt, nt, num, den):
+    """Add each point's bilinear weights to the four surrounding grid vertices."""
+    for i in range(strikes.shape[0]):
+        fx = (strikes[i] - k0) / dk
+        fy = (dte[i] - t0) / dt
+        # Positive form so NaN coordinates are skipped too
+        if not (0 <= fx <= nk - 1 and 0 <= fy <= nt - 1):
+            continue
+        ix = min(int(fx), nk - 2)
+        iy = min(int(fy), nt - 2)
+        fx -= ix
+        fy -= iy
+        
+        w00 = (1 - fx) * (1 - fy)
+        w10 = fx * (1 - fy)
+        w01 = (1 - fx) * fy
+        w11 = fx * fy
+        num[iy, ix] += w00 * iv[i]
+        num[iy, ix + 1] += w10 * iv[i]
+        num[iy + 1, ix] += w01 * iv[i]
+        num[iy + 1, ix + 1] += w11 * iv[i]
+        den[iy, ix] += w00
+        den[iy, ix + 1] += w10
+        den[iy + 1, ix] += w01
+        den[iy + 1, ix + 1] += w11
+
+
+if njit is not None:
+    _scatter_bilinear = njit(cache=True)(_scatter_bilinear)
+
+
+def _fill_gaps(Z: np.ndarray, axis: int) -> None:
+    """Linearly interpolate, in place, NaN runs between valid cells along one axis."""
+    idx = np.arange(Z.shape[axis])
+    for line in np.moveaxis(Z, axis, -1):
+        ok = ~np.isnan(line)
+        if ok.sum() < 2:
+            continue
+        lo, hi = idx[ok][[0, -1]]
+        line[lo:hi + 1] = np.interp(idx[lo:hi + 1], idx[ok], line[ok])
+
+
+def grid_from_unstructured_data(strikes: np.ndarray, dte: np.ndarray, iv: np.ndarray,
+                                k_grid: np.ndarray, t_grid: np.ndarray) -> np.ndarray:
+    """
+    Scatter points onto the regular (t_grid, k_grid) mesh with bilinear weights,
+    then linearly fill empty cells lying between rasterized ones, first along
+    DTE and then along strike. Cells outside the span of the data stay NaN.
+    """
+    nk, nt = len(k_grid), len(t_grid)
+    dk = k_grid[1] - k_grid[0]
+    dt = t_grid[1] - t_grid[0]
+    
+    # Rasterize on the mesh extended to cover every point, so points beyond
+    # the plotted range still anchor the fill, then crop back at the end
+    fx = (strikes - k_grid[0]) / dk
+    fy = (dte - t_grid[0]) / dt
+    finite = np.isfinite(fx) & np.isfinite(fy)
+    px0 = px1 = py0 = py1 = 0
+    if finite.any():
+        px0 = max(0, int(np.ceil(-fx[finite].min())))
+        px1 = max(0, int(np.ceil(fx[finite].max() - (nk - 1))))
+        py0 = max(0, int(np.ceil(-fy[finite].min())))
+        py1 = max(0, int(np.ceil(fy[finite].max() - (nt - 1))))
+    k0 = k_grid[0] - px0 * dk
+    t0 = t_grid[0] - py0 * dt
+    nkx, ntx = nk + px0 + px1, nt + py0 + py1
+    
+    num = np.zeros((ntx, nkx), dtype=np.float32)
+    den = np.zeros((ntx, nkx), dtype=np.float32)
+    
+    if njit is not None:
+        _scatter_bilinear(strikes, dte, iv, k0, dk, nkx, t0, dt, ntx, num, den)
+    else:
+        fx = (strikes - k0) / dk
+        fy = (dte - t0) / dt
+        inside = (fx >= 0) & (fx <= nkx - 1) & (fy >= 0) & (fy <= ntx - 1)
+        fx, fy, iv = fx[inside], fy[inside], iv[inside]
+        ix = np.minimum(fx.astype(np.intp), nkx - 2)
+        iy = np.minimum(fy.astype(np.intp), ntx - 2)
+        fx = fx - ix
+        fy = fy - iy
+        for dx, dy, w in [(0, 0, (1 - fx) * (1 - fy)), (1, 0, fx * (1 - fy)),
+                          (0, 1, (1 - fx) * fy), (1, 1, fx * fy)]:
+            np.add.at(num, (iy + dy, ix + dx), w * iv)
+            np.add.at(den, (iy + dy, ix + dx), w)
+    
+    Z = np.divide(num, den, out=np.full_like(num, np.nan), where=den > 0)
+    _fill_gaps(Z, axis=0)
+    _fill_gaps(Z, axis=1)
+    return Z[py0:py0 + nt, px0:px0 + nk]
+
+
 def build_animation(curves: pd.DataFrame, view: str = 'both', speed_ms: int = 500) -> go.Figure:
-    buckets = sorted(curves['bucket_time'].unique())
     spot = curves['underlying'].median()
     
     k_min, k_max = spot * 0.90, spot * 1.10
-    k_grid = np.linspace(k_min, k_max, 25)
-    t_grid = np.linspace(1, 45, 18)
-    K, T = np.meshgrid(k_grid, t_grid)
+    k_grid = np.linspace(k_min, k_max, 25, dtype=np.float32)
+    t_grid = np.linspace(1, 45, 18, dtype=np.float32)
+    empty_Z = np.full((len(t_grid), len(k_grid)), np.nan, dtype=np.float32)
     
     colormap = {'puts': 'Reds', 'calls': 'Blues', 'both': 'Viridis'}
     colors = {'puts': 'red', 'calls': 'blue'}
@@ -97,39 +242,40 @@ def build_animation(curves: pd.DataFrame, view: str = 'both', speed_ms: int = 50
         data = curves[curves['cp'] == 'Call']
     else:
         data = curves
+    data = data.astype({'strike': np.float32, 'days_to_exp': np.float32, 'iv': np.float32})
+    
+    # Only buckets with enough points to render a frame/surface are kept
+    sizes = data.groupby('bucket_time').size()
+    data = data[data['bucket_time'].isin(sizes.index[sizes >= 5])]
+    otm = data[data['is_otm'] == 1]
+    otm_sizes = otm.groupby('bucket_time').size()
+    otm = otm[otm['bucket_time'].isin(otm_sizes.index[otm_sizes >= 5])]
+    
+    otm_groups = dict(list(otm.groupby('bucket_time', sort=False)))
+    side_groups = {}
+    if view == 'both':
+        side_groups = dict(list(data.groupby(['bucket_time', 'cp'], sort=False, observed=True)))
     
     frames = []
     
-    for bt in buckets:
-        bt_data = data[data['bucket_time'] == bt]
-        if len(bt_data) < 5:
-            continue
-        
-        frame_traces = []
+    for bt, bt_data in data.groupby('bucket_time'):
+        otm = otm_groups.get(bt)
+        Z = empty_Z
+        if otm is not None:
+            Z = grid_from_unstructured_data(
+                otm['strike'].values,
+                otm['days_to_exp'].values,
+                otm['iv'].values * 100,
+                k_grid, t_grid
+            )
         
-        otm = bt_data[bt_data['is_otm'] == True]
-        if len(otm) >= 5:
-            try:
-                Z = griddata(
-                    (otm['strike'].values, otm['days_to_exp'].values),
-                    otm['iv'].values * 100,
-                    (K, T),
-                    method='linear'
-                )
-                frame_traces.append(go.Surface(
-                    x=K, y=T, z=Z,
-                    colorscale=colormap.get(view, 'Viridis'),
-                    opacity=0.7,
-                    showscale=True,
-                    colorbar=dict(title='IV %', len=0.5)
-                ))
-            except:
-                pass
+        # Frames only carry z; axes and styling live on the initial trace.
+        frame_traces = [go.Surface(z=Z)]
         
         if view == 'both':
             for side, color in [('Put', 'red'), ('Call', 'blue')]:
-                subset = bt_data[bt_data['cp'] == side]
-                if len(subset) > 0:
+                subset = side_groups.get((bt, side))
+                if subset is not None:
                     frame_traces.append(go.Scatter3d(
                         x=subset['strike'],
                         y=subset['days_to_exp'],
@@ -155,10 +301,19 @@ def build_animation(curves: pd.DataFrame, view: str = 'both', speed_ms: int = 50
             name='ATM'
         ))
         
-        if frame_traces:
-            frames.append(go.Frame(data=frame_traces, name=str(bt)))
+        frames.append(go.Frame(data=frame_traces, name=str(bt)))
     
     fig = go.Figure(data=frames[0].data, frames=frames)
+    fig.update_traces(
+        x=k_grid, y=t_grid,
+        colorscale=colormap.get(view, 'Viridis'),
+        opacity=0.7,
+        showscale=True,
+        colorbar=dict(title='IV %', len=0.5),
+        selector=dict(type='surface')
+    )
+    
+    labels = pd.to_datetime([f.name for f in frames]).strftime('%H:%M').tolist()
     
     sliders = [{
         'active': 0,
@@ -166,9 +321,9 @@ def build_animation(curves: pd.DataFrame, view: str = 'both', speed_ms: int = 50
         'pad': {'t': 50},
         'steps': [
             {'args': [[f.name], {'frame': {'duration': speed_ms, 'redraw': True}, 'mode': 'immediate'}],
-             'label': pd.Timestamp(f.name).strftime('%H:%M'),
+             'label': label,
              'method': 'animate'}
-            for f in frames
+            for f, label in zip(frames, labels)
         ]
     }]
     
@@ -216,10 +371,8 @@ def build_animation(curves: pd.DataFrame, view: str = 'both', speed_ms: int = 50
 def build_price_chart(df: pd.DataFrame, freq: str = '5min') -> go.Figure:
     """Build OHLC candlestick chart for underlying price."""
     
-    ohlc = df.groupby(df['bucket_time']).agg({
-        'uPrc': ['first', 'max', 'min', 'last']
-    }).reset_index()
-    ohlc.columns = ['time', 'open', 'high', 'low', 'close']
+    ohlc = (df.set_index('timestamp')['uPrc'].resample(freq).ohlc()
+            .dropna().reset_index().rename(columns={'timestamp': 'time'}))
     
     fig = go.Figure()
     
@@ -249,28 +402,49 @@ def build_price_chart(df: pd.DataFrame, freq: str = '5min') -> go.Figure:
     return fig
 
 
-def run(csv_path: str, output_dir: str = 'docs'):
+def run(csv_path: str, output_dir: str = 'docs', cache_dir: str = '.cache'):
+    """
+    Build the price chart and vol surface pages for one trades file.
+    
+    Trade prices and aggregated curves are cached as Parquet in cache_dir
+    (None disables it), keyed on the file path and mtime only. Changing
+    filter_trades/aggregate_curves parameters does not invalidate the
+    cache, and stale entries are never removed; delete cache_dir to reset.
+    """
+    import hashlib
     import os
     os.makedirs(output_dir, exist_ok=True)
     
-    df = load_trades(csv_path)
-    df = filter_trades(df)
-    curves = aggregate_curves(df)
+    cache_key = hashlib.md5(f'{csv_path}:{os.path.getmtime(csv_path)}'.encode()).hexdigest()[:8]
+    prices_cache = f'{cache_dir}/prices_{cache_key}.parquet'
+    curves_cache = f'{cache_dir}/curves_{cache_key}.parquet'
+    
+    if cache_dir and os.path.exists(prices_cache) and os.path.exists(curves_cache):
+        df = pd.read_parquet(prices_cache)
+        curves = pd.read_parquet(curves_cache)
+        print(f'Loaded cached curves {curves_cache}')
+    else:
+        df = load_trades(csv_path)
+        df = filter_trades(df)
+        curves = aggregate_curves(df)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Only the price chart needs trade-level data
+            df[['timestamp', 'uPrc']].to_parquet(prices_cache, index=False)
+            curves.to_parquet(curves_cache, index=False)
     
     # Price chart
     fig_price = build_price_chart(df)
-    fig_price.write_html(f'{output_dir}/price_chart.html')
+    fig_price.write_html(f'{output_dir}/price_chart.html', include_plotlyjs='cdn')
     print(f'Saved {output_dir}/price_chart.html')
     
-    for view in ['both', 'puts', 'calls']:
-        fig = build_animation(curves, view=view)
-        out = f'{output_dir}/vol_surface_v3_{view}.html'
-        fig.write_html(out)
-        print(f'Saved {out}')
+    figs = {view: build_animation(curves, view=view) for view in ['both', 'puts', 'calls']}
+    figs['clean'] = figs['both']
     
-    fig_clean = build_animation(curves, view='both')
-    fig_clean.write_html(f'{output_dir}/vol_surface_v3_clean.html')
-    print(f'Saved {output_dir}/vol_surface_v3_clean.html')
+    for name, fig in figs.items():
+        out = f'{output_dir}/vol_surface_v3_{name}.html'
+        fig.write_html(out, include_plotlyjs='cdn')
+        print(f'Saved {out}')
 
 
 if __name__ == '__main__':